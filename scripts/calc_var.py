@@ -124,19 +124,17 @@ def calc_stats_table_parallel(filename, ndof=None, nprocs=1):
         A table of stats, not necessarily in the same order as the input!
     """
     results = []
-
-    def collect_result(result):
-        results.append(result)
-
     pool = mp.Pool(nprocs)
     for i in range(nprocs):
-        pool.apply_async(calc_stats_table,
-                         args=[filename, ndof],
-                         kwds={'start':i, 'stride':nprocs},
-                         callback=collect_result)
+        r = pool.apply_async(calc_stats_table,
+                             args=[filename, ndof],
+                             kwds={'start':i, 'stride':nprocs})
+        results.append(r)
     pool.close()
     pool.join()
-    stats_tab = astropy.table.vstack(results)
+    # This forces any raised exceptions within the apply_async to be re-raised here
+    # rather than silently dropping that worker's rows from the stats table
+    stats_tab = astropy.table.vstack([r.get() for r in results])
     return stats_tab
 
 
@@ -4,6 +4,9 @@ from astropy.table import Table
 import dateutil
 import dateutil.parser
 import numpy as np
+import matplotlib
+# we only ever write files, so avoid the start up cost (and fork issues) of an interactive backend
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 from matplotlib.cm import viridis_r
@@ -11,55 +14,144 @@ import argparse
 import sys
 import os
 import multiprocessing as mp
-import datetime
+from functools import partial
 
 __author__ = ["Paul Hancock"]
 __date__ = '2022/03/25'
 
+# merge path segments that are within a pixel of each other when rendering
+plt.rcParams['path.simplify'] = True
+plt.rcParams['path.simplify_threshold'] = 1.0
 
-def plot_summary_table(filename, plotfile):
+
+def _read_table(filename, columns=None):
     """
-    Create a summary plot for all sources, identifying which are likely to be variable.
+    Read a table, memory mapping the data if it is a FITS file.
 
     parameters
     ----------
     filename : str
         Input table filename
+    columns : list or None
+        Only read these columns. Default None -> read all columns
+
+    return
+    ------
+    tab : `astropy.table.Table`
+        The table
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    # only the FITS reader supports memmap, and then the unused columns are never read from disk
+    if ext in ('.fits', '.fit'):
+        tab = Table.read(filename, memmap=True)
+    # the ascii readers can skip the unwanted columns while parsing
+    elif ext in ('.csv', '.ecsv') and columns is not None:
+        return Table.read(filename, include_names=columns)
+    else:
+        tab = Table.read(filename)
+    if columns is not None:
+        tab = tab[columns]
+    return tab
+
+
+def _render_summary(md, pval_peak_flux, mean_peak_flux, plotfile, max_scatter=10000):
+    """
+    Draw the variability summary plot and save it to a file.
+
+    parameters
+    ----------
+    md : array-like
+        Debiased modulation index of each source
+    pval_peak_flux : array-like
+        KS test p-value of each source
+    mean_peak_flux : array-like
+        Mean peak flux of each source
     plotfile : str
         Filename for the output plot file
+    max_scatter : int
+        Above this many sources the plot shows the mean flux in hexagonal bins
+        rather than one point per source. Default =10000
     """
-    tab = Table.read(filename)
-    pval_peak_flux = tab['pval_peak_flux_ks']
-    md = tab['md']
-    mean_peak_flux = tab['mean_peak_flux']
+    # matplotlib works in single precision anyway, so do the log10 once into float32 buffers
+    md = np.asarray(md, dtype=np.float32)
+    log_pval = np.log10(np.asarray(pval_peak_flux, dtype=np.float32))
+    log_flux = np.log10(np.asarray(mean_peak_flux, dtype=np.float32))
+
+    # plot limits, shared by the axes, the hexbin grid, and the shaded regions
+    xlim = (-0.3, 0.3)
+    ylim = (-11, 1.001)
 
     kwargs = {'fontsize':14}
     fig = plt.figure(figsize=(5,8))
 
-
     ax = fig.add_subplot(1,1,1)
-    cax = ax.scatter(md, np.log10(pval_peak_flux), c = np.log10(mean_peak_flux), cmap=viridis_r)
+    if len(md) > max_scatter:
+        # the cost of binning doesn't grow with the number of points drawn
+        cax = ax.hexbin(md, log_pval, C=log_flux, reduce_C_function=np.mean, gridsize=80,
+                        extent=xlim + ylim, cmap=viridis_r)
+    else:
+        # rasterize the points so that vector outputs don't carry one path per source
+        cax = ax.scatter(md, log_pval, c=log_flux, cmap=viridis_r, s=4, rasterized=True)
     cb = fig.colorbar(cax,ax=ax)
     cb.set_label("log10(Peak flux in epoch 1) (Jy)", **kwargs)
 
-    ax.set_ylim((-11,1.001))
-    ax.set_xlim((-0.3,0.3))
+    ax.set_ylim(ylim)
+    ax.set_xlim(xlim)
     ax.set_ylabel("log(p_val_ks)", **kwargs)
     ax.set_xlabel("Debiased modulation index ($m_d$)", **kwargs)
     ax.axhline(-3, c='k')
     ax.axvline(0.05, c='k')
     ax.text(0.1, -5, "variable", **kwargs)
-    ax.fill_between([-0.3,0.05],-25, y2=2, color='k', alpha=0.2)
-    ax.fill_betweenx([-3,2],0.05, x2=0.3, color='k', alpha=0.2)
+    ax.fill_between([xlim[0],0.05],-25, y2=2, color='k', alpha=0.2)
+    ax.fill_betweenx([-3,2],0.05, x2=xlim[1], color='k', alpha=0.2)
     ax.text(-0.25, -5, "not variable", **kwargs)
-    plt.savefig(plotfile)
+    fig.savefig(plotfile)
+    plt.close(fig)
     return
 
 
-def plot_lc_table(flux_table, stats_table, start=0, stride=1, plot_dir="plots", dates=False):
+def plot_summary_table(filename, plotfile, force=False):
     """
-    Create individual light curve plots.
-    Each plot is saved to plots/uuid.png
+    Create a summary plot for all sources, identifying which are likely to be variable.
+    The plot is not remade if it was already created from an unchanged input table.
+
+    parameters
+    ----------
+    filename : str
+        Input table filename
+    plotfile : str
+        Filename for the output plot file
+    force : bool
+        If true then always remake the plot. Default =False
+    """
+    # the size/mtime of the input table is recorded next to the plot
+    signature = "{0}:{1}".format(os.path.getmtime(filename), os.path.getsize(filename))
+    cachefile = plotfile + '.cache'
+    if not force and os.path.exists(plotfile) and os.path.exists(cachefile):
+        with open(cachefile) as f:
+            if f.read() == signature:
+                print("{0} is up to date ... skip".format(plotfile))
+                return
+
+    tab = _read_table(filename, columns=['pval_peak_flux_ks', 'md', 'mean_peak_flux'])
+    # extract plain float arrays (masked entries -> nan) rather than handing Columns to matplotlib
+    pval_peak_flux, md, mean_peak_flux = [np.asarray(np.ma.filled(tab[c].astype(np.float64), np.nan))
+                                          for c in ('pval_peak_flux_ks', 'md', 'mean_peak_flux')]
+    # sources with too few points have pval=0, drop them so log10 doesn't give -inf
+    mask = pval_peak_flux > 0
+    pval_peak_flux = pval_peak_flux[mask]
+    md = md[mask]
+    mean_peak_flux = np.abs(mean_peak_flux[mask])
+    _render_summary(md, pval_peak_flux, mean_peak_flux, plotfile)
+    with open(cachefile, 'w') as f:
+        f.write(signature)
+    return
+
+
+def _load_light_curves(flux_table, stats_table, start=0, stride=1, plot_dir="plots", dates=False):
+    """
+    Read the flux and stats tables and extract the light curves that still need plotting.
+    Sources whose plot already exists, or which have no data, are skipped.
 
     parameters
     ----------
@@ -74,62 +166,159 @@ def plot_lc_table(flux_table, stats_table, start=0, stride=1, plot_dir="plots",
 
     stride : int
         Process every Nth row of the table. Default =1
-    
+
+    plot_dir : str
+        Location of the plots (default="plots")
+
     dates : bool = False
-        If true then use dates for the x-axis value/format
+        If true then the x-axis values are the epoch dates, otherwise they count the epochs
+
+    return
+    ------
+    light_curves : list
+        One (uuid, epoch_times, fluxes, err_fluxes, (m, md, chisq)) tuple per source
     """
-    flux_tab = Table.read(flux_table).filled(0) # replace numerical blanks with zeros
-    stats_tab = Table.read(stats_table)
+    flux_tab = _read_table(flux_table)
+    stats_tab = _read_table(stats_table, columns=['uuid', 'm', 'md', 'chisq_peak_flux'])
     epochs = [a for a in flux_tab.colnames if a.startswith('epoch')]
     fluxes = [a for a in flux_tab.colnames if a.startswith('peak_flux')]
     err_fluxes = [a for a in flux_tab.colnames if a.startswith('err_peak_flux')]
-    for row in flux_tab[start::stride]:
-        fname = '{0}/{1}.png'.format(plot_dir, row['uuid'])
-        print(fname, end='')
-        if os.path.exists(fname):
-            print(" ... skip")
-            continue
-        srow = stats_tab[stats_tab['uuid'] == row['uuid']]
+    # drop the columns we don't plot (image, local_rms, ...) before they are copied
+    flux_tab = flux_tab[['uuid'] + epochs + fluxes + err_fluxes].filled(0) # replace numerical blanks with zeros
+    # map uuid -> row index so that we don't scan the stats table for every source
+    # (FITS tables store the uuids as bytes, so decode them to match the flux table rows)
+    uuid_to_idx = {u: i for i, u in enumerate(np.asarray(stats_tab['uuid']).astype(str))}
+    # drop sources that have already been plotted before doing any per-row work
+    rows = flux_tab[start::stride]
+    uuids = np.asarray(rows['uuid']).astype(str)
+    pending = np.array([not os.path.exists('{0}/{1}.png'.format(plot_dir, u)) for u in uuids], dtype=bool)
+    if not np.all(pending):
+        print("Skipping {0} existing plots".format(np.sum(~pending)))
+    rows = rows[pending]
+    uuids = uuids[pending]
+
+    # gather the light curve columns into (source, epoch) arrays once, rather than copying each row
+    flux = np.column_stack([np.asarray(rows[a]) for a in fluxes])
+    err_flux = np.column_stack([np.asarray(rows[a]) for a in err_fluxes])
+    epoch = np.column_stack([np.asarray(rows[a]).astype(str) for a in epochs])
+    valid = np.char.find(epoch, 'None') < 0
 
-        # Sort date by date
-        mask = np.where(['None' not in row[a] for a in epochs])[0]
-        if len(mask) == 0 :
-            print(" ... no data")
+    light_curves = []
+    for i, uuid in enumerate(uuids):
+        mask = valid[i]
+        if not np.any(mask):
+            print('{0}/{1}.png ... no data'.format(plot_dir, uuid))
             continue
-        epoch_mask = list(np.choose(mask, epochs))
-        flux_mask = list(np.choose(mask, fluxes))
-        err_flux_mask = list(np.choose(mask, err_fluxes))
+        srow = stats_tab[uuid_to_idx[uuid]]
         if dates:
-            epoch_times = [datetime.datetime.strptime(a, "%Y-%m-%dT%H:%M:%S") for a in list(row[epochs][epoch_mask])]
+            # numpy parses the ISO-8601 epoch strings much faster than strptime
+            epoch_times = epoch[i][mask].astype('datetime64[s]')
+            # the epoch columns are not necessarily in time order, so sort by date
+            order = np.argsort(epoch_times)
         else:
-            epoch_times = list(range(len(epoch_mask)))
+            # the epoch strings aren't needed at all in this case
+            epoch_times = np.arange(np.sum(mask))
+            order = slice(None)
+        light_curves.append((uuid,
+                             epoch_times[order],
+                             flux[i][mask][order],
+                             err_flux[i][mask][order],
+                             (srow['m'], srow['md'], srow['chisq_peak_flux'])))
+    return light_curves
+
+
+def _plot_light_curves(light_curves, plot_dir="plots", dates=False, draft=False):
+    """
+    Plot a list of light curves, as returned by `_load_light_curves`.
+    Each plot is saved to plot_dir/uuid.png
+
+    parameters
+    ----------
+    light_curves : list
+        (uuid, epoch_times, fluxes, err_fluxes, (m, md, chisq)) tuples
+
+    plot_dir : str
+        Location to store the plots (default="plots")
+
+    dates : bool = False
+        If true then use dates for the x-axis value/format
+
+    draft : bool = False
+        If true then save lower resolution plots
+    """
+    # these are diagnostic plots so favour fast png compression over small files
+    save_kwargs = {'pil_kwargs': {'compress_level': 1}}
+    if draft:
+        save_kwargs['dpi'] = 80
+    # reuse a single figure for all the plots rather than building a new one per source
+    # constrained layout keeps the labels on the figure without the extra draw that bbox_inches='tight' needs
+    fig, ax = plt.subplots(constrained_layout=True)
+    for uuid, epoch_times, flux, err_flux, (m, md, chisq) in light_curves:
+        fname = '{0}/{1}.png'.format(plot_dir, uuid)
+        print(fname, end='')
 
         # Annotate with stats
-        s = f"m={srow['m'][0]:5.3f}\nmd={srow['md'][0]:4.2f}\nchisq={srow['chisq_peak_flux'][0]:4.1f}"
+        s = f"m={m:5.3f}\nmd={md:4.2f}\nchisq={chisq:4.1f}"
 
-        yerrs = list(row[err_fluxes][err_flux_mask])
-        yerrs = [e if e > 0 else 0 for e in yerrs]
-        # convert epochs to datetime objects
-        fig, ax = plt.subplots()
+        yerrs = [e if e > 0 else 0 for e in err_flux]
+        ax.cla()
         ax.errorbar(epoch_times,
-                    list(row[fluxes][flux_mask]), 
+                    list(flux),
                     yerr=yerrs, 
                     label=s)
         ax.set_ylabel('Flux Density (Jy/Beam)')
         ax.set_xlabel('Epoch')
-        ax.set_title('{0}'.format(row['uuid']))
+        ax.set_title('{0}'.format(uuid))
         ax.legend()
         if dates:
-            fig.autofmt_xdate()
+            # rotate the dates as fig.autofmt_xdate() would, but without the subplots_adjust call
+            # which fights with (or on older matplotlib, switches off) the constrained layout
+            ax.tick_params(axis='x', labelrotation=30)
+            plt.setp(ax.get_xticklabels(), ha='right')
             ax.fmt_xdata = mdates.DateFormatter("%Y-%m-%dT%H:%M:%S")
-        plt.savefig(fname, bbox_inches='tight')
-        plt.close(fig)
+        fig.savefig(fname, **save_kwargs)
         print(" ... done")
+    plt.close(fig)
+    return
+
+
+def plot_lc_table(flux_table, stats_table, start=0, stride=1, plot_dir="plots", dates=False, draft=False):
+    """
+    Create individual light curve plots.
+    Each plot is saved to plots/uuid.png
+
+    parameters
+    ----------
+    flux_table : str
+        Filename of the flux table
+
+    stats_table : str
+        Filename of the stats table
+
+    start : int
+        Starting row (default=0)
+
+    stride : int
+        Process every Nth row of the table. Default =1
+    
+    dates : bool = False
+        If true then use dates for the x-axis value/format
+
+    draft : bool = False
+        If true then save lower resolution plots
+    """
+    light_curves = _load_light_curves(flux_table, stats_table, start=start, stride=stride, plot_dir=plot_dir,
+                                      dates=dates)
+    _plot_light_curves(light_curves, plot_dir=plot_dir, dates=dates, draft=draft)
     return
 
 
-def plot_lc_table_parallel(flux_table, stats_table, light_curve_dir, dates, nprocs=1, debug=False):
+def plot_lc_table_parallel(flux_table, stats_table, light_curve_dir, dates, nprocs=1, debug=False, batch_size=64,
+                           draft=False):
     """
+    Create individual light curve plots using multiple cores if available.
+    The tables are read once, and batches of light curves are handed out to the worker processes.
+
     parameters
     ----------
     flux_table : str
@@ -146,33 +335,30 @@ def plot_lc_table_parallel(flux_table, stats_table, light_curve_dir, dates, npro
 
     nprocs : int
         Number of processes to use simultaneously
+
+    debug : bool
+        If true then plot everything in this process so that errors are raised directly
+
+    batch_size : int
+        Maximum number of light curves sent to a worker at once. Default =64
+
+    draft : bool
+        If true then save lower resolution plots
     """
-    pool = mp.Pool(nprocs)
-    results = []
-    for i in range(nprocs):
-        r=pool.apply_async(
-                            plot_lc_table,
-                            args=[
-                                flux_table,
-                                stats_table
-                            ],
-                            kwds={
-                                'start':i,
-                                'stride':nprocs,
-                                'plot_dir':light_curve_dir,
-                                'dates':dates
-                            }
-                       )
-        if debug:
-            r.get()
-        else:
-            results.append(r)
-    pool.close()
-    pool.join()
-    if not debug:
-        # This forces any raised exceptions within the apply_async to be re-raised here
-        for r in results:
-            r.get()
+    light_curves = _load_light_curves(flux_table, stats_table, plot_dir=light_curve_dir, dates=dates)
+    # keep all the workers busy when there are only a few light curves
+    batch_size = max(1, min(batch_size, len(light_curves) // nprocs))
+    batches = [light_curves[i:i+batch_size] for i in range(0, len(light_curves), batch_size)]
+    plot = partial(_plot_light_curves, plot_dir=light_curve_dir, dates=dates, draft=draft)
+    if debug:
+        for batch in batches:
+            plot(batch)
+        return
+    with mp.Pool(nprocs) as pool:
+        # consume the results so that any exceptions in the workers are re-raised here
+        for _ in pool.imap_unordered(plot, batches):
+            pass
+    return
 
 
 if __name__ == "__main__":
@@ -190,6 +376,10 @@ if __name__ == "__main__":
                         help="The light curve plots output directory")
     group1.add_argument("--dates", dest='dates', action='store_true', default=False,
                         help="Individual plots have date on the horizontal axis.")
+    group1.add_argument("--draft", dest='draft', action='store_true', default=False,
+                        help="Save individual plots at a lower resolution. Default:False")
+    group1.add_argument("--force", dest='force', action='store_true', default=False,
+                        help="Remake the summary plot even if the stats table is unchanged. Default:False")
     group1.add_argument("--cores", dest='cores', type=int, default=None,
                         help="Number of cores to use: Default all")
     group1.add_argument("--debug", dest='debug', action='store_true', default=False,
@@ -203,14 +393,15 @@ if __name__ == "__main__":
     if results.ftable or results.stable:
         if not (results.ftable and results.stable):
             print("ERROR: --stable and --ftable are both required, only one supplied.")
-        plot_summary_table(results.stable, results.plotfile)
+        plot_summary_table(results.stable, results.plotfile, force=results.force)
         if results.all:
             plot_lc_table_parallel(results.ftable, 
                                    results.stable, 
                                    results.light_curve_dir, 
                                    results.dates,
                                    nprocs=results.cores,
-                                   debug=results.debug)
+                                   debug=results.debug,
+                                   draft=results.draft)
     else:
         parser.print_help()
         sys.exit()